@@ -6,34 +6,57 @@ docker-watcher
 - No image tag in names.
 - Terse SMTP messages (e.g., "Gitea container is down at ...").
 - Exponential backoff for alerts.
-- NEW: MAX_LOOP_ALERTS (default 3): stop loop alerts after N until recovery.
+- MAX_LOOP_ALERTS (default 3): stop loop alerts after N until recovery.
+- Event-driven: only down containers are re-checked, when their grace ends.
+- Alerts raised together are sent as one digest (DIGEST_COALESCE_SEC).
+- State survives watcher restarts (STATE_FILE).
 """
 
 import os
+import json
 import time
+import heapq
+import queue
+import signal
 import smtplib
 import socket
+import threading
+from email import policy
 from email.message import EmailMessage
-from collections import defaultdict, deque
-from datetime import datetime, timedelta, timezone
+from email.utils import formatdate
+from collections import deque, namedtuple
+from datetime import datetime, timezone
 
 import docker
 
 ENV = lambda k, d=None: os.environ.get(k, d)
+_TRUTHY = frozenset({"1", "true", "yes", "on"})
 
 # ---- Configuration (env) ----
 SMTP_HOST           = ENV("SMTP_HOST", "mail")
 SMTP_PORT           = int(ENV("SMTP_PORT", "25"))
 SMTP_FROM           = ENV("SMTP_FROM", "docker-watcher@localhost")
 SMTP_TO             = [x.strip() for x in ENV("SMTP_TO", "root@localhost").split(",") if x.strip()]
-SMTP_TLS            = ENV("SMTP_TLS", "0") in ("1", "true", "True", "yes", "on")
+SMTP_TLS            = ENV("SMTP_TLS", "0").lower() in _TRUTHY
 SMTP_USER           = ENV("SMTP_USER", "") or None
 SMTP_PASS           = ENV("SMTP_PASS", "") or None
 SMTP_TIMEOUT        = float(ENV("SMTP_TIMEOUT", "15"))
 
+# Deadline for a single Docker API call (events stream is not affected)
+DOCKER_TIMEOUT      = float(ENV("DOCKER_TIMEOUT", "5"))
+# Reuse a container inspect for this long (bursts of events for one container)
+INSPECT_CACHE_SEC   = float(ENV("INSPECT_CACHE_SEC", "1"))
+
 # Restart loop detection
 RESTARTS_IN_WINDOW  = int(ENV("RESTARTS_IN_WINDOW", "3"))
 RESTART_WINDOW_SEC  = int(ENV("RESTART_WINDOW_SEC", "60"))
+# Optional long window that must also show a loop (0 = disabled)
+RESTART_LONG_WINDOW_SEC = int(ENV("RESTART_LONG_WINDOW_SEC", "0"))
+RESTARTS_IN_LONG_WINDOW = int(ENV("RESTARTS_IN_LONG_WINDOW", "6"))
+RESTART_HISTORY     = max(64, RESTARTS_IN_WINDOW, RESTARTS_IN_LONG_WINDOW)
+RESTART_HORIZON_SEC = max(RESTART_WINDOW_SEC, RESTART_LONG_WINDOW_SEC)
+# Drop a repeat loop alert for the same container within this many seconds
+LOOP_DEDUP_SEC      = int(ENV("LOOP_DEDUP_SEC", "30"))
 
 # Exponential backoff (per container) for repeated alerts
 BACKOFF_BASE_SEC    = int(ENV("BACKOFF_BASE_SEC", "60"))
@@ -42,8 +65,19 @@ BACKOFF_MAX_SEC     = int(ENV("BACKOFF_MAX_SEC", "3600"))
 # Loop alert suppression cap
 MAX_LOOP_ALERTS     = int(ENV("MAX_LOOP_ALERTS", "3"))
 
+# Down/loop alerts raised within this window go out as one digest email
+DIGEST_COALESCE_SEC = float(ENV("DIGEST_COALESCE_SEC", "5"))
+DIGEST_MAX          = int(ENV("DIGEST_MAX", "20"))
+# On shutdown, wait this long for queued alerts to go out (docker stop allows 10s)
+SHUTDOWN_MAIL_WAIT  = float(ENV("SHUTDOWN_MAIL_WAIT", "8"))
+
+# State snapshot so a watcher restart doesn't reset timers/backoff ("" = off)
+STATE_FILE          = ENV("STATE_FILE", "/var/lib/docker-watcher/state.json")
+STATE_SAVE_EVERY    = int(ENV("STATE_SAVE_EVERY", "60"))
+STATE_MAX_AGE_SEC   = int(ENV("STATE_MAX_AGE_SEC", "3600"))
+
 # General behavior
-INCLUDE_RECOVERY    = ENV("INCLUDE_RECOVERY", "1") in ("1", "true", "True", "yes", "on")
+INCLUDE_RECOVERY    = ENV("INCLUDE_RECOVERY", "1").lower() in _TRUTHY
 
 # Ping cadence & down grace
 CHECK_PING_EVERY    = int(ENV("CHECK_PING_EVERY", "60"))     # default 60s
@@ -52,144 +86,319 @@ DOWN_GRACE_SEC      = int(ENV("DOWN_GRACE_SEC", "60"))       # default 60s
 TZ_STR              = ENV("TZ", "UTC")
 HOSTNAME            = ENV("WATCHER_HOSTNAME", socket.gethostname())
 
-def now_utc():
-    return datetime.now(timezone.utc)
+# Container states treated as "down" when seeding
+SEED_STATUSES       = ["created", "restarting", "exited", "paused", "dead"]
 
-def fmt_ts(dt: datetime) -> str:
+_TS_FMT = "%Y-%m-%d %H:%M:%S %Z"
+
+def _load_tz():
     try:
         import pytz  # optional
-        tz = pytz.timezone(TZ_STR)
-        return dt.astimezone(tz).strftime("%Y-%m-%d %H:%M:%S %Z")
+        return pytz.timezone(TZ_STR)
     except Exception:
-        return dt.astimezone().strftime("%Y-%m-%d %H:%M:%S %Z")
+        return None  # astimezone(None) -> local zone
+
+_TZ = _load_tz()
+
+def now_utc():
+    return datetime.now(timezone.utc)
+
+def fmt_ts(dt: datetime) -> str:
+    return dt.astimezone(_TZ).strftime(_TS_FMT)
 
 def log(msg: str):
     print(f"[{fmt_ts(now_utc())}] {msg}", flush=True)
 
-def send_email(subject: str, body: str):
+# From/To never change; parse the address headers once and reuse them
+_FROM_HEADER = policy.default.header_factory("From", SMTP_FROM)
+_TO_HEADER = policy.default.header_factory("To", ", ".join(SMTP_TO))
+
+_RAW_FROM_TO = f"From: {SMTP_FROM}\r\nTo: {', '.join(SMTP_TO)}\r\n"
+
+def build_email(subject: str, body: str) -> bytes:
+    # Alerts are short ASCII text; format the message directly instead of
+    # going through EmailMessage's charset/encoding/folding machinery.
+    try:
+        return (
+            f"{_RAW_FROM_TO}Subject: {subject}\r\nDate: {formatdate()}\r\n"
+            "MIME-Version: 1.0\r\nContent-Type: text/plain; charset=us-ascii\r\n\r\n"
+            + body.replace("\n", "\r\n") + "\r\n"
+        ).encode("ascii")
+    except UnicodeEncodeError:
+        pass
+    # Non-ASCII name/host; let the email package encode it
     msg = EmailMessage()
-    msg["From"] = SMTP_FROM
-    msg["To"] = ", ".join(SMTP_TO)
+    msg["From"] = _FROM_HEADER
+    msg["To"] = _TO_HEADER
     msg["Subject"] = subject
+    msg["Date"] = formatdate()
     msg.set_content(body)
-
-    log(f"SMTP -> {SMTP_HOST}:{SMTP_PORT} tls={SMTP_TLS} to={SMTP_TO}")
-    with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT) as s:
-        if SMTP_TLS:
-            s.starttls()
-        if SMTP_USER and SMTP_PASS:
-            s.login(SMTP_USER, SMTP_PASS)
-        s.send_message(msg)
+    return msg.as_bytes(policy=msg.policy.clone(linesep="\r\n"))
 
 def short_id(cid: str) -> str:
     return cid[:12] if cid else ""
 
-def container_display_name(container):
+def container_display_name(name):
     # Only the container name; no image/tag.
-    return (container.name or "").lstrip("/")
+    return (name or "").lstrip("/")
+
+# What the notifier needs to know about a container; built from an event
+# or from a low-level inspect instead of a full docker-py model. name is
+# already the display name.
+ContainerRef = namedtuple("ContainerRef", "id name status")
+
+def container_ref(attrs: dict) -> ContainerRef:
+    return ContainerRef(attrs.get("Id"), container_display_name(attrs.get("Name")),
+                        (attrs.get("State") or {}).get("Status"))
+
+# Event actions that imply the container's state. kill/oom are ignored:
+# the container may survive them, and a real exit is followed by "die".
+# A paused container counts as down, same as when seeding.
+EVENT_STATUS = {
+    "start": "running", "die": "exited", "stop": "exited",
+    "pause": "exited", "unpause": "running",
+}
+
+# Only the events we act on; dockerd drops everything else server-side
+EVENT_FILTERS = {"type": "container", "event": [*EVENT_STATUS, "destroy", "rename"]}
+
+# How far before the newest seen event to resume the stream after a drop
+EVENT_REPLAY_SLACK_NS = 10**9
 
 class Notifier:
     def __init__(self):
-        self.client = docker.from_env()
+        self.client = docker.from_env(timeout=DOCKER_TIMEOUT)
         self.low_client = self.client.api
 
+        # events are read on one thread and mail is sent on another so that
+        # neither a quiet stream nor a slow SMTP relay delays the main loop
+        self._events = queue.Queue()
+        self._outbox = queue.Queue()
+
+        # SMTP connection reused across sends; owned by the mail thread
+        self._smtp = None
+        self._mail_thread = None
+
+        # down/loop alerts waiting to go out as one digest
+        self._pending = []            # [(subject, body)]
+        self._flush_at = None
+
         # id -> "running"|"exited"
         self.container_state = {}
 
         # loop detection
-        self.restarts = defaultdict(lambda: deque(maxlen=64))
+        self.restarts = {}            # id -> deque of recent exit times
 
         # backoff/mute
-        self.mute_until = defaultdict(lambda: datetime.min.replace(tzinfo=timezone.utc))
-        self.backoff_level = defaultdict(int)
+        self.mute_until = {}
+        self.backoff_level = {}
 
         # down grace + single-down alert
         self.down_since = {}          # id -> first seen exited at
         self.down_alerted = set()     # ids already down-alerted until recovery
+        self._due = []                # heap of (grace deadline, id); may hold stale entries
 
         # loop alert capping
-        self.loop_alerts_sent = defaultdict(int)  # id -> count of loop alerts sent
-        self.loop_alerts_suppressed = set()       # ids suppressed until recovery
+        self.loop_alerts_sent = {}    # id -> loop alerts sent; capped until recovery
+        self._last_push = {}          # (id, kind) -> time of last alert sent
+
+        self._name_cache = {}         # id -> display name
+        self._inspect_cache = {}      # id -> (expires at, inspect attrs)
 
         # docker daemon state
         self.docker_up = None
 
+        self._load_state()
+
     def _in_backoff(self, cid: str) -> bool:
-        return now_utc() < self.mute_until[cid]
+        return time.monotonic() < self.mute_until.get(cid, 0.0)
 
     def _bump_backoff(self, cid: str):
-        lvl = self.backoff_level[cid]
+        lvl = self.backoff_level.get(cid, 0)
         delay = min(BACKOFF_BASE_SEC * (2 ** max(lvl, 0)), BACKOFF_MAX_SEC)
-        self.mute_until[cid] = now_utc() + timedelta(seconds=delay)
+        self.mute_until[cid] = time.monotonic() + delay
         self.backoff_level[cid] = min(lvl + 1, 30)
 
     def _reset_backoff(self, cid: str):
-        self.mute_until[cid] = datetime.min.replace(tzinfo=timezone.utc)
-        self.backoff_level[cid] = 0
+        self.mute_until.pop(cid, None)
+        self.backoff_level.pop(cid, None)
+
+    def _clear_down(self, cid: str):
+        # Reset all suppression/backoff on recovery
+        self._reset_backoff(cid)
+        self.down_since.pop(cid, None)
+        self.down_alerted.discard(cid)
+        self.loop_alerts_sent.pop(cid, None)
+
+    def _forget(self, cid: str):
+        # Container was removed; drop everything we track for it
+        self._clear_down(cid)
+        self.container_state.pop(cid, None)
+        self.restarts.pop(cid, None)
+        self._last_push.pop((cid, "loop"), None)
+        self._name_cache.pop(cid, None)
+        self._inspect_cache.pop(cid, None)
 
     def _notify_once(self, subject: str, body: str):
+        self._flush_alerts(force=True)  # keep earlier alerts ahead of this one
+        self._outbox.put((subject, body))
+
+    def _queue_alert(self, subject: str, body: str):
+        # Containers often fail together (host OOM, storage); hold alerts
+        # briefly so a storm goes out as one email instead of dozens.
+        self._pending.append((subject, body))
+        if self._flush_at is None:
+            self._flush_at = time.monotonic() + DIGEST_COALESCE_SEC
+        if len(self._pending) >= DIGEST_MAX or DIGEST_COALESCE_SEC <= 0:
+            self._flush_alerts(force=True)
+
+    def _flush_alerts(self, force: bool = False):
+        if not self._pending or not (force or time.monotonic() >= self._flush_at):
+            return
+        pending, self._pending, self._flush_at = self._pending, [], None
+        if len(pending) == 1:
+            self._outbox.put(pending[0])
+            return
+        subject = f"{len(pending)} container alerts on {HOSTNAME} at {fmt_ts(now_utc())}"
+        body = "\n\n".join(b for _, b in pending)
+        self._outbox.put((subject, body))
+
+    def _smtp_connect(self):
+        if self._smtp is not None:
+            try:
+                if self._smtp.noop()[0] == 250:
+                    return self._smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._smtp_close()
+
+        log(f"SMTP -> {SMTP_HOST}:{SMTP_PORT} tls={SMTP_TLS} to={SMTP_TO}")
+        s = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        try:
+            if SMTP_TLS:
+                s.starttls()
+            if SMTP_USER and SMTP_PASS:
+                s.login(SMTP_USER, SMTP_PASS)
+        except Exception:
+            s.close()
+            raise
+        self._smtp = s
+        return s
+
+    def _smtp_close(self):
+        s, self._smtp = self._smtp, None
+        if s is None:
+            return
         try:
-            send_email(subject, body)
-        except Exception as e:
-            log(f"ERROR sending email: {e}")
+            s.quit()
+        except Exception:
+            s.close()
+
+    def send_email(self, subject: str, body: str):
+        msg = build_email(subject, body)
+        try:
+            self._smtp_connect().sendmail(SMTP_FROM, SMTP_TO, msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # Relay dropped the connection between the liveness check and
+            # the send; reconnect once. Anything else (auth, refused
+            # recipients, timeouts after DATA) is not retried, so an alert
+            # is never sent twice.
+            self._smtp_close()
+            self._smtp_connect().sendmail(SMTP_FROM, SMTP_TO, msg)
+
+    def _mail_worker(self):
+        while True:
+            item = self._outbox.get()
+            if item is None:
+                # Shutdown; close the connection from the thread that uses it
+                self._smtp_close()
+                return
+            subject, body = item
+            try:
+                self.send_email(subject, body)
+            except Exception as e:
+                log(f"ERROR sending email: {e}")
+
+    def _event_reader(self):
+        # On reconnect, ask dockerd to replay from shortly before the newest
+        # event we saw so nothing that happened during the gap is lost. Only
+        # that replayed prefix is deduped, by exact key; the live stream can
+        # legitimately carry out-of-order or equal timestamps.
+        newest = 0        # highest timeNano handed on
+        seen = deque()    # (timeNano, id, Action) handed on within the replay slack
+        while True:
+            boundary, replay = newest, set(seen)
+            since = "%d.%09d" % divmod(newest - EVENT_REPLAY_SLACK_NS, 10**9) if newest else None
+            try:
+                for ev in self.low_client.events(decode=True, filters=EVENT_FILTERS, since=since):
+                    ev = ev or {}
+                    key = (ev.get("timeNano") or ev.get("time", 0) * 10**9, ev.get("id"), ev.get("Action"))
+                    if replay:
+                        if key in replay:
+                            continue  # already handed on before the reconnect
+                        if key[0] > boundary:
+                            replay = None  # past the gap; live from here on
+                    self._events.put(ev)
+                    newest = max(newest, key[0])
+                    seen.append(key)
+                    while seen and seen[0][0] < newest - EVENT_REPLAY_SLACK_NS:
+                        seen.popleft()
+                log("Event stream ended, reconnecting in 3s...")
+            except Exception as e:
+                log(f"Event stream error: {e}; retrying in 3s...")
+            time.sleep(3)
 
     def _notify_down(self, container):
         cid = container.id
         if self._in_backoff(cid):
-            log(f"Muted DOWN alert for {container_display_name(container)} (backoff active)")
+            log(f"Muted DOWN alert for {container.name} (backoff active)")
             return
-        name = container_display_name(container)
+        name = container.name
         ts = fmt_ts(now_utc())
         subject = f"{name} container is down at {ts}"
         body = f"{name} container is down at {ts} on {HOSTNAME}."
-        self._notify_once(subject, body)
+        self._queue_alert(subject, body)
         self._bump_backoff(cid)
         self.down_alerted.add(cid)
 
     def _notify_loop(self, container, count: int, window_sec: int):
         cid = container.id
 
-        # Respect hard cap
-        if cid in self.loop_alerts_suppressed:
-            log(f"Loop alerts suppressed for {container_display_name(container)} (max reached)")
+        last = self._last_push.get((cid, "loop"))
+        if last is not None and time.monotonic() - last < LOOP_DEDUP_SEC:
             return
-        if self.loop_alerts_sent[cid] >= MAX_LOOP_ALERTS:
-            self.loop_alerts_suppressed.add(cid)
-            log(f"Reached MAX_LOOP_ALERTS={MAX_LOOP_ALERTS} for {container_display_name(container)}; suppressing until recovery")
+
+        # Respect hard cap
+        if self.loop_alerts_sent.get(cid, 0) >= MAX_LOOP_ALERTS:
+            log(f"Loop alerts suppressed for {container.name} (max reached)")
             return
 
         if self._in_backoff(cid):
-            log(f"Muted LOOP alert for {container_display_name(container)} (backoff active)")
+            log(f"Muted LOOP alert for {container.name} (backoff active)")
             return
 
-        name = container_display_name(container)
+        name = container.name
         ts = fmt_ts(now_utc())
         subject = f"{name} is restarting frequently ({count} times ~{window_sec}s) at {ts}"
         body = (
             f"{name} is restarting frequently ({count} restarts within ~{window_sec}s) at {ts} on {HOSTNAME}.\n"
             f"Further alerts will use exponential backoff and stop entirely after {MAX_LOOP_ALERTS} loop alerts until recovery."
         )
-        self._notify_once(subject, body)
+        self._queue_alert(subject, body)
         self._bump_backoff(cid)
-        self.loop_alerts_sent[cid] += 1
-
-        # If this send hit the cap, mark suppressed for any subsequent attempts
-        if self.loop_alerts_sent[cid] >= MAX_LOOP_ALERTS:
-            self.loop_alerts_suppressed.add(cid)
+        self._last_push[(cid, "loop")] = time.monotonic()
+        sent = self.loop_alerts_sent[cid] = self.loop_alerts_sent.get(cid, 0) + 1
+        if sent >= MAX_LOOP_ALERTS:
+            log(f"Reached MAX_LOOP_ALERTS={MAX_LOOP_ALERTS} for {name}; suppressing until recovery")
 
     def _notify_up(self, container):
         cid = container.id
-        name = container_display_name(container)
+        name = container.name
         ts = fmt_ts(now_utc())
         subject = f"{name} container is back up at {ts}"
         body = f"{name} container is back up at {ts} on {HOSTNAME}."
         self._notify_once(subject, body)
-        # Reset all suppression/backoff on recovery
-        self._reset_backoff(cid)
-        self.down_since.pop(cid, None)
-        self.down_alerted.discard(cid)
-        self.loop_alerts_sent[cid] = 0
-        self.loop_alerts_suppressed.discard(cid)
+        self._clear_down(cid)
 
     def _notify_docker_state(self, up: bool):
         state = "UP" if up else "DOWN"
@@ -198,13 +407,100 @@ class Notifier:
         self._notify_once(subject, body)
 
     def _seed_states(self):
-        for c in self.client.containers.list(all=True):
-            st = (c.status or "").lower()
-            self.container_state[c.id] = "running" if st == "running" else "exited"
-            if st != "running":
-                self.down_since[c.id] = now_utc()
+        # Ids restored from the state file; some may be gone by now
+        restored = set(self.container_state) | set(self.restarts) | {cid for cid, _ in self._last_push}
+
+        # Only non-running containers need seeding; running ones are picked up
+        # from their first event. Let dockerd filter instead of listing all.
+        down = set()
+        for c in self.low_client.containers(all=True, filters={"status": SEED_STATUSES}):
+            cid = c["Id"]
+            down.add(cid)
+            self.container_state[cid] = "exited"
+            if cid not in self.down_since:
+                self._mark_down(cid)
+
+        if restored:
+            alive = {c["Id"] for c in self.low_client.containers(all=True, filters={"id": sorted(restored)})}
+            for cid in restored:
+                if cid not in alive:
+                    # Removed while we weren't watching
+                    self._forget(cid)
+                elif self.container_state.get(cid) == "exited" and cid not in down:
+                    # Restored as down but started while we weren't watching
+                    self.container_state.pop(cid, None)
+                    self._clear_down(cid)
         log(f"Seeded {len(self.container_state)} container states.")
 
+    def _save_state(self):
+        if not STATE_FILE:
+            return
+        # Timers are monotonic, which doesn't survive a restart; save them
+        # as wall-clock epoch seconds.
+        offset = time.time() - time.monotonic()
+        wall = lambda t: t + offset
+        snap = {
+            "saved_at": time.time(),
+            "container_state": self.container_state,
+            "down_since": {k: wall(v) for k, v in self.down_since.items()},
+            "down_alerted": sorted(self.down_alerted),
+            "mute_until": {k: wall(v) for k, v in self.mute_until.items()},
+            "backoff_level": self.backoff_level,
+            "loop_alerts_sent": self.loop_alerts_sent,
+            "restarts": {k: [wall(t) for t in v] for k, v in self.restarts.items()},
+            "last_push": [[cid, kind, wall(t)] for (cid, kind), t in self._last_push.items()],
+        }
+        tmp = STATE_FILE + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(STATE_FILE) or ".", exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump(snap, f)
+            os.replace(tmp, STATE_FILE)
+        except OSError as e:
+            log(f"ERROR saving state to {STATE_FILE}: {e}")
+
+    def _load_state(self):
+        if not STATE_FILE:
+            return
+        try:
+            if time.time() - os.path.getmtime(STATE_FILE) > STATE_MAX_AGE_SEC:
+                log(f"Ignoring stale state file {STATE_FILE}")
+                return
+            with open(STATE_FILE) as f:
+                snap = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log(f"ERROR loading state from {STATE_FILE}: {e}")
+            return
+
+        offset = time.time() - time.monotonic()
+        dt = lambda t: float(t) - offset
+        try:
+            container_state = dict(snap["container_state"])
+            down_since = {k: dt(v) for k, v in snap["down_since"].items()}
+            down_alerted = set(snap["down_alerted"])
+            mute_until = {k: dt(v) for k, v in snap["mute_until"].items()}
+            backoff_level = dict(snap["backoff_level"])
+            loop_alerts_sent = dict(snap["loop_alerts_sent"])
+            restarts = {k: deque((dt(t) for t in v), maxlen=RESTART_HISTORY) for k, v in snap["restarts"].items()}
+            last_push = {(cid, kind): dt(t) for cid, kind, t in snap["last_push"]}
+        except (KeyError, TypeError, ValueError) as e:
+            log(f"ERROR loading state from {STATE_FILE}: {e}")
+            return
+
+        self.container_state = container_state
+        self.down_since = down_since
+        self.down_alerted = down_alerted
+        self.mute_until = mute_until
+        self.backoff_level = backoff_level
+        self.loop_alerts_sent = loop_alerts_sent
+        self.restarts = restarts
+        self._last_push = last_push
+        for cid, started in self.down_since.items():
+            heapq.heappush(self._due, (started + DOWN_GRACE_SEC, cid))
+        log(f"Restored state for {len(self.container_state)} containers from {STATE_FILE}")
+
     def _check_docker_ping(self):
         try:
             self.low_client.ping()
@@ -221,44 +517,139 @@ class Notifier:
         cid = container.id
         started = self.down_since.get(cid)
         if started is None:
-            self.down_since[cid] = now_utc()
+            self._mark_down(cid)
             return
         if cid in self.down_alerted:
             return
-        if (now_utc() - started).total_seconds() >= DOWN_GRACE_SEC:
+        if time.monotonic() - started >= DOWN_GRACE_SEC:
             self._notify_down(container)
 
-    def _handle_event(self, ev: dict):
-        if ev.get("Type") != "container":
-            return
+    def _inspect(self, cid: str) -> dict:
+        now = time.monotonic()
+        hit = self._inspect_cache.get(cid)
+        if hit is not None and hit[0] > now:
+            return hit[1]
+        attrs = self.low_client.inspect_container(cid)
+        if len(self._inspect_cache) >= 256:
+            self._inspect_cache = {k: v for k, v in self._inspect_cache.items() if v[0] > now}
+        self._inspect_cache[cid] = (now + INSPECT_CACHE_SEC, attrs)
+        return attrs
+
+    def _mark_down(self, cid: str):
+        started = time.monotonic()
+        self.down_since[cid] = started
+        heapq.heappush(self._due, (started + DOWN_GRACE_SEC, cid))
+
+    def _next_due_in(self):
+        # Seconds until the earliest down timer fires, or None
+        if not self._due:
+            return None
+        return self._due[0][0] - time.monotonic()
+
+    def _grace_elapsed(self, cid: str) -> bool:
+        started = self.down_since.get(cid)
+        if started is None or cid in self.down_alerted:
+            return False
+        return time.monotonic() - started >= DOWN_GRACE_SEC
+
+    def _sweep_down(self):
+        # Pop the down timers that are due; entries for containers that
+        # recovered or were re-marked down since are skipped.
+        now = time.monotonic()
+        while self._due and self._due[0][0] <= now:
+            _, cid = heapq.heappop(self._due)
+            if not self._grace_elapsed(cid):
+                continue
+            try:
+                container = container_ref(self._inspect(cid))
+                self._name_cache[cid] = container.name
+            except docker.errors.NotFound:
+                self._forget(cid)
+                continue
+            except Exception as e:
+                log(f"Periodic sweep error: {e}")
+                heapq.heappush(self._due, (now + CHECK_PING_EVERY, cid))
+                continue
+            if (container.status or "").lower() == "running":
+                # Came back without us seeing the start event
+                self._recovered(container)
+                self.container_state[cid] = "running"
+                continue
+            self._maybe_fire_down_after_grace(container)
+            if cid not in self.down_alerted:
+                # Muted by backoff; look again once it expires
+                retry = max(self.mute_until.get(cid, now), now + 1)
+                heapq.heappush(self._due, (retry, cid))
+
+    def _loop_sustained(self, restarts) -> bool:
+        # A burst in the short window only counts as a loop if the long
+        # window agrees; keeps one-off flaps from using up loop alerts.
+        if RESTART_LONG_WINDOW_SEC <= 0:
+            return True
+        long_start = time.monotonic() - RESTART_LONG_WINDOW_SEC
+        return sum(1 for t in restarts if t >= long_start) >= RESTARTS_IN_LONG_WINDOW
+
+    def _recovered(self, container):
+        if INCLUDE_RECOVERY:
+            self._notify_up(container)
+        else:
+            # Even if not notifying, clear all state on recovery
+            self._clear_down(container.id)
 
+    def _handle_event(self, ev: dict):
         cid = ev.get("id")
         action = ev.get("Action") or ev.get("status") or ""
         if not cid:
             return
-
-        try:
-            container = self.client.containers.get(cid)
-        except Exception:
+        if action == "destroy":
+            self._forget(cid)
             return
 
-        # Loop detection
-        if action in ("die", "oom", "kill", "stop"):
-            self.restarts[cid].append(now_utc())
-            window_start = now_utc() - timedelta(seconds=RESTART_WINDOW_SEC)
-            recent = [t for t in self.restarts[cid] if t >= window_start]
-            if len(recent) >= RESTARTS_IN_WINDOW:
-                self._notify_loop(container, len(recent), RESTART_WINDOW_SEC)
+        # Name and state come from the event itself; only inspect when
+        # neither the event nor the cache has a name.
+        name = ((ev.get("Actor") or {}).get("Attributes") or {}).get("name")
+        if name:
+            name = self._name_cache[cid] = container_display_name(name)
+        if action == "rename":
+            return
+        status = EVENT_STATUS.get(action)
+        if status is None:
+            return
+        if not name:
+            name = self._name_cache.get(cid)
+        if not name:
+            try:
+                name = self._inspect(cid).get("Name")
+            except Exception:
+                return
+            name = self._name_cache[cid] = container_display_name(name)
+        container = ContainerRef(cid, name, status)
+
+        # Loop detection; every exit emits exactly one "die" (stop/kill/oom
+        # come alongside it), so count those only.
+        if action == "die":
+            now = time.monotonic()
+            dq = self.restarts.setdefault(cid, deque(maxlen=RESTART_HISTORY))
+            dq.append(now)
+            horizon = now - RESTART_HORIZON_SEC
+            while dq[0] < horizon:
+                dq.popleft()
+            if RESTART_HORIZON_SEC == RESTART_WINDOW_SEC:
+                recent = len(dq)
+            else:
+                window_start = now - RESTART_WINDOW_SEC
+                recent = sum(1 for t in dq if t >= window_start)
+            if recent >= RESTARTS_IN_WINDOW and self._loop_sustained(dq):
+                self._notify_loop(container, recent, RESTART_WINDOW_SEC)
 
         # State transitions
-        st = (container.status or "").lower()
         prev = self.container_state.get(cid)
-        current = "running" if st == "running" else "exited"
+        current = status
 
         if prev is None:
             self.container_state[cid] = current
             if current == "exited":
-                self.down_since[cid] = now_utc()
+                self._mark_down(cid)
             return
 
         if prev == "running" and current == "exited":
@@ -266,64 +657,83 @@ class Notifier:
         elif prev == "exited" and current == "exited":
             self._maybe_fire_down_after_grace(container)
         elif prev == "exited" and current == "running":
-            if INCLUDE_RECOVERY:
-                self._notify_up(container)
-            else:
-                # Even if not notifying, clear all state on recovery
-                self._reset_backoff(cid)
-                self.down_since.pop(cid, None)
-                self.down_alerted.discard(cid)
-                self.loop_alerts_sent[cid] = 0
-                self.loop_alerts_suppressed.discard(cid)
+            self._recovered(container)
 
         self.container_state[cid] = current
 
+    def close(self):
+        self._save_state()
+        if self._mail_thread is None:
+            self._smtp_close()
+            return
+        # Alerts already counted in the saved state (down_alerted, loop
+        # counts) would never be resent after a restart; get them out now.
+        # The mail thread drains the outbox, then closes SMTP itself.
+        self._flush_alerts(force=True)
+        self._outbox.put(None)
+        self._mail_thread.join(timeout=SHUTDOWN_MAIL_WAIT)
+        if self._mail_thread.is_alive():
+            log(f"Gave up waiting for {self._outbox.qsize()} queued email(s) on shutdown")
+
     def run(self):
         self._seed_states()
+        self._mail_thread = threading.Thread(target=self._mail_worker, name="mail", daemon=True)
+        self._mail_thread.start()
         self._check_docker_ping()
-        last_ping = time.time()
+        next_ping = time.monotonic() + CHECK_PING_EVERY
+        next_save = time.monotonic() + STATE_SAVE_EVERY
 
         log("Listening for Docker events...")
-        events = self.low_client.events(decode=True)
+        threading.Thread(target=self._event_reader, name="events", daemon=True).start()
         while True:
-            if time.time() - last_ping >= CHECK_PING_EVERY:
-                self._check_docker_ping()
-                last_ping = time.time()
-                # Periodic sweep for grace elapse
-                try:
-                    for c in self.client.containers.list(all=True):
-                        if (c.status or "").lower() != "running":
-                            self._maybe_fire_down_after_grace(c)
-                except Exception as e:
-                    log(f"Periodic sweep error: {e}")
-
+            # Wait for an event, but never past the next ping, down timer or digest
+            timeout = next_ping - time.monotonic()
+            due_in = self._next_due_in()
+            if due_in is not None:
+                timeout = min(timeout, due_in)
+            if self._flush_at is not None:
+                timeout = min(timeout, self._flush_at - time.monotonic())
             try:
-                ev = next(events)
-            except StopIteration:
-                log("Event stream ended, reconnecting in 3s...")
-                time.sleep(3)
-                events = self.low_client.events(decode=True)
-                continue
-            except Exception as e:
-                log(f"Event stream error: {e}; retrying in 3s...")
-                time.sleep(3)
-                events = self.low_client.events(decode=True)
-                continue
+                ev = self._events.get(timeout=max(timeout, 0))
+            except queue.Empty:
+                ev = None
 
+            if time.monotonic() >= next_ping:
+                self._check_docker_ping()
+                next_ping = time.monotonic() + CHECK_PING_EVERY
+            self._sweep_down()
+            self._flush_alerts()
+            if time.monotonic() >= next_save:
+                self._save_state()
+                next_save = time.monotonic() + STATE_SAVE_EVERY
+
+            if ev is None:
+                continue
             try:
-                self._handle_event(ev or {})
+                self._handle_event(ev)
             except Exception as e:
                 log(f"ERROR handling event: {e}")
 
+def _on_sigterm(signum, frame):
+    # docker stop sends SIGTERM; unwind so main() saves state and closes SMTP
+    log("Shutting down (SIGTERM)")
+    raise SystemExit(0)
+
 def main():
     log("Starting docker-watcher")
+    signal.signal(signal.SIGTERM, _on_sigterm)
+    notifier = None
     try:
-        Notifier().run()
+        notifier = Notifier()
+        notifier.run()
     except KeyboardInterrupt:
         log("Shutting down (KeyboardInterrupt)")
     except Exception as e:
         log(f"FATAL: {e}")
         time.sleep(2)
+    finally:
+        if notifier is not None:
+            notifier.close()
 
 if __name__ == "__main__":
     main()